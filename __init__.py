@@ -3,14 +3,25 @@
 # the full copyright notices and license terms.
 from trytond.pool import Pool
 from . import configuration
+from . import ir
 from . import party
 from . import sale
+from . import stock
 
 def register():
     Pool.register(
         configuration.Configuration,
         configuration.ConfigurationRemainingStock,
+        ir.Cron,
         party.Party,
         party.PartyRemainingStock,
+        party.UpdateSalesRemainingStockDone,
         sale.Sale,
+        sale.SaleRemainingStockWarehouse,
+        sale.SaleRemainingStockBacklog,
+        stock.ShipmentOut,
+        stock.Move,
         module='sale_remaining_stock', type_='model')
+    Pool.register(
+        party.UpdateSalesRemainingStock,
+        module='sale_remaining_stock', type_='wizard')
@@ -0,0 +1,33 @@
+#The COPYRIGHT file at the top level of this repository contains the full
+#copyright notices and license terms.
+from sql import Column
+from sql.aggregate import Count, Min
+
+from trytond.transaction import Transaction
+
+
+def delete_duplicates(Model, *names):
+    """
+    Delete the records of Model having the same values for the columns names
+    keeping the first one
+
+    NULL values are considered equal.
+    Return if duplicates were found.
+    """
+    cursor = Transaction().connection.cursor()
+    table = Model.__table__()
+    duplicate = Model.__table__()
+
+    columns = [Column(table, n) for n in names]
+    cursor.execute(*table.select(
+            Count(table.id),
+            group_by=columns,
+            having=Count(table.id) > 1,
+            limit=1))
+    if not cursor.fetchone():
+        return False
+    cursor.execute(*table.delete(
+            where=~table.id.in_(duplicate.select(
+                    Min(duplicate.id),
+                    group_by=[Column(duplicate, n) for n in names]))))
+    return True
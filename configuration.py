@@ -1,9 +1,17 @@
 #The COPYRIGHT file at the top level of this repository contains the full
 #copyright notices and license terms.
-from trytond.model import ModelSQL, fields
+from sql import Null
+from sql.operators import Equal
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.model import Exclude, ModelSQL, Unique, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.modules.company.model import (
     CompanyMultiValueMixin, CompanyValueMixin)
+from trytond.transaction import Transaction
+
+from .common import delete_duplicates
 
 __all__ = ['Configuration', 'ConfigurationRemainingStock']
 
@@ -25,6 +33,8 @@ def default_func(field_name):
 class Configuration(CompanyMultiValueMixin, metaclass=PoolMeta):
     __name__ = 'sale.configuration'
     remaining_stock = fields.MultiValue(remaining_stock)
+    _remaining_stock_cache = Cache(
+        'sale.configuration.remaining_stock', context=False)
 
     @classmethod
     def multivalue_model(cls, field):
@@ -35,12 +45,73 @@ class Configuration(CompanyMultiValueMixin, metaclass=PoolMeta):
 
     default_remaining_stock = default_func('remaining_stock')
 
+    @classmethod
+    def get_remaining_stock(cls, party=None):
+        """
+        Return the effective remaining stock of the party for the company of
+        the context falling back to the company configuration
+        """
+        company = Transaction().context.get('company')
+        party_id = party.id if party and party.id and party.id >= 0 else None
+        # The unsaved parties are not cached as their key would be the one of
+        # the configuration
+        cached = party is None or party_id is not None
+        key = (company, party_id)
+        if cached:
+            remaining_stock = cls._remaining_stock_cache.get(key)
+            if remaining_stock is not None:
+                return remaining_stock
+
+        config = cls(1)
+        remaining_stock = (config.get_multivalue(
+                'remaining_stock', company=company)
+            or 'create_shipment')
+        if party and party_id is not None:
+            remaining_stock = (party.get_multivalue(
+                    'remaining_stock', company=company)
+                or remaining_stock)
+        elif party:
+            remaining_stock = (getattr(party, 'remaining_stock', None)
+                or remaining_stock)
+        if cached:
+            cls._remaining_stock_cache.set(key, remaining_stock)
+        return remaining_stock
+
 
 class ConfigurationRemainingStock(ModelSQL, CompanyValueMixin):
     "Sale Configuration Remaining Stock"
     __name__ = 'sale.configuration.remaining.stock'
     remaining_stock = remaining_stock
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('company_unique', Unique(t, t.company),
+                'sale_remaining_stock.'
+                'msg_configuration_remaining_stock_unique'),
+            ('singleton', Exclude(t, (t.id * 0, Equal),
+                    where=t.company == Null),
+                'sale_remaining_stock.'
+                'msg_configuration_remaining_stock_unique'),
+            ]
+
+    @classmethod
+    def __register__(cls, module):
+        if backend.TableHandler.table_exist(cls._table):
+            # Migration: remove duplicated values keeping the first one
+            delete_duplicates(cls, 'company')
+
+        super().__register__(module)
+
     @classmethod
     def default_remaining_stock(cls):
         return 'create_shipment'
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        super().on_modification(mode, records, field_names=field_names)
+        Configuration._remaining_stock_cache.clear()
@@ -0,0 +1,17 @@
+#The COPYRIGHT file at the top level of this repository contains the full
+#copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.extend([
+                ('sale.sale|reconcile_remaining_stock',
+                    "Reconcile Sale Remaining Stock"),
+                ])
+        cls.methods_company_needed.add(
+            'sale.sale|reconcile_remaining_stock')
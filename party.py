@@ -1,12 +1,26 @@
 #The COPYRIGHT file at the top level of this repository contains the full
 #copyright notices and license terms.
-from trytond.model import ModelSQL, fields
+from collections import defaultdict
+
+from sql import Null
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp
+from sql.operators import Equal
+
+from trytond import backend
+from trytond.model import Exclude, ModelSQL, ModelView, Unique, fields
 from trytond.modules.company.model import (CompanyMultiValueMixin,
     CompanyValueMixin)
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+from trytond.wizard import Button, StateTransition, StateView, Wizard
+
+from .common import delete_duplicates
 
-__all__ = ['Party', 'PartyRemainingStock']
+__all__ = ['Party', 'PartyRemainingStock', 'UpdateSalesRemainingStock',
+    'UpdateSalesRemainingStockDone']
 
 remaining_stock = fields.Selection([
         ('create_shipment', 'Create Shipment'),
@@ -28,6 +42,12 @@ class Party(CompanyMultiValueMixin, metaclass=PoolMeta):
     remaining_stock = fields.MultiValue(remaining_stock)
     remaining_stocks = fields.One2Many(
         'party.remaining.stock', 'party', "Remaining Stocks")
+    effective_remaining_stock = fields.Function(fields.Selection(
+            remaining_stock.selection, "Effective Remaining Stock",
+            help="The remaining stock of the party for the company "
+            "or of the company configuration."),
+        'get_effective_remaining_stock',
+        searcher='search_effective_remaining_stock')
 
     @classmethod
     def multivalue_model(cls, field):
@@ -38,6 +58,160 @@ class Party(CompanyMultiValueMixin, metaclass=PoolMeta):
 
     default_remaining_stock = default_func('remaining_stock')
 
+    @classmethod
+    def resolve_remaining_stock(cls, parties, company=None):
+        """
+        Return a dictionary with the effective remaining stock of each party
+        for the company falling back to the company configuration
+        """
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        RemainingStock = pool.get('party.remaining.stock')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = RemainingStock.__table__()
+
+        if company is None:
+            company = transaction.context.get('company')
+        company = int(company) if company is not None else None
+        with transaction.set_context(company=company):
+            default = Configuration.get_remaining_stock()
+
+        values = {}
+        party_ids = list({p.id for p in parties})
+        for sub_ids in grouped_slice(party_ids, backend.MAX_QUERY_PARAMS):
+            where = fields.SQL_OPERATORS['in'](table.party, list(sub_ids))
+            if company is not None:
+                where &= (table.company == company) | (table.company == Null)
+            else:
+                where &= table.company == Null
+            cursor.execute(*table.select(
+                    table.party, table.remaining_stock,
+                    where=where,
+                    order_by=[(table.company == Null).asc, table.id.asc]))
+            for party_id, remaining_stock in cursor:
+                values.setdefault(party_id, remaining_stock)
+
+        result = {}
+        for party_id in party_ids:
+            if party_id in values:
+                remaining_stock = values[party_id]
+            else:
+                remaining_stock = cls.default_remaining_stock()
+            result[party_id] = remaining_stock or default
+            Configuration._remaining_stock_cache.set(
+                (company, party_id), result[party_id])
+        return result
+
+    @classmethod
+    def _effective_remaining_stock_query(cls):
+        """
+        Return the query of the effective remaining stock of the parties for
+        the company of the context
+        """
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        RemainingStock = pool.get('party.remaining.stock')
+        party = cls.__table__()
+        company_value = RemainingStock.__table__()
+        default_value = RemainingStock.__table__()
+
+        company = Transaction().context.get('company')
+        default = Configuration.get_remaining_stock()
+        return (party
+            .join(company_value, 'LEFT', condition=(
+                    (company_value.party == party.id)
+                    & (company_value.company == (
+                            company if company is not None else Null))))
+            .join(default_value, 'LEFT', condition=(
+                    (default_value.party == party.id)
+                    & (default_value.company == Null)))
+            .select(
+                party.id.as_('id'),
+                Coalesce(
+                    Case(
+                        (company_value.id != Null,
+                            company_value.remaining_stock),
+                        (default_value.id != Null,
+                            default_value.remaining_stock),
+                        else_=cls.default_remaining_stock()),
+                    default).as_('remaining_stock')))
+
+    @classmethod
+    def get_effective_remaining_stock(cls, parties, name):
+        return cls.resolve_remaining_stock(parties)
+
+    @classmethod
+    def search_effective_remaining_stock(cls, name, clause):
+        _, operator, value = clause
+        query = cls._effective_remaining_stock_query()
+        Operator = fields.SQL_OPERATORS[operator]
+        return [('id', 'in', query.select(
+                    query.id,
+                    where=Operator(query.remaining_stock, value)))]
+
+    @classmethod
+    def order_effective_remaining_stock(cls, tables):
+        party, _ = tables[None]
+        key = 'effective_remaining_stock'
+        if key not in tables:
+            query = cls._effective_remaining_stock_query()
+            join = party.join(query, 'LEFT', condition=query.id == party.id)
+            tables[key] = {
+                None: (join.right, join.condition),
+                }
+        else:
+            query, _ = tables[key][None]
+        return [query.remaining_stock]
+
+    @classmethod
+    def update_sales_remaining_stock(cls, parties, company=None):
+        """
+        Update the remaining stock of the draft and quotation sales of the
+        parties for the company to their effective remaining stock
+
+        Return a dictionary with the number of sales updated per remaining
+        stock.
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        sale = Sale.__table__()
+
+        if company is None:
+            company = transaction.context.get('company')
+        company = int(company) if company is not None else None
+
+        policies = defaultdict(list)
+        resolved = cls.resolve_remaining_stock(parties, company=company)
+        for party_id, remaining_stock in resolved.items():
+            policies[remaining_stock].append(party_id)
+
+        result = {}
+        for remaining_stock, party_ids in policies.items():
+            result[remaining_stock] = 0
+            for sub_ids in grouped_slice(party_ids, backend.MAX_QUERY_PARAMS):
+                where = (fields.SQL_OPERATORS['in'](sale.party, list(sub_ids))
+                    & sale.state.in_(['draft', 'quotation'])
+                    & ((sale.remaining_stock != remaining_stock)
+                        | (sale.remaining_stock == Null)))
+                if company is not None:
+                    where &= sale.company == company
+                cursor.execute(*sale.update(
+                        [sale.remaining_stock, sale.write_uid,
+                            sale.write_date],
+                        [remaining_stock, transaction.user,
+                            CurrentTimestamp()],
+                        where=where))
+                result[remaining_stock] += max(cursor.rowcount, 0)
+
+        transaction.counter += 1
+        for cache in transaction.cache.values():
+            if Sale.__name__ in cache:
+                cache[Sale.__name__].clear()
+        return result
+
 
 class PartyRemainingStock(ModelSQL, CompanyValueMixin):
     "Party Remaining Stock"
@@ -48,6 +222,63 @@ class PartyRemainingStock(ModelSQL, CompanyValueMixin):
         depends=['company'])
     remaining_stock = remaining_stock
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('party_company_unique', Unique(t, t.party, t.company),
+                'sale_remaining_stock.msg_party_remaining_stock_unique'),
+            ('party_exclude', Exclude(t, (t.party, Equal),
+                    where=t.company == Null),
+                'sale_remaining_stock.msg_party_remaining_stock_unique'),
+            ]
+
+    @classmethod
+    def __register__(cls, module):
+        if backend.TableHandler.table_exist(cls._table):
+            # Migration: remove duplicated values keeping the first one
+            delete_duplicates(cls, 'party', 'company')
+
+        super().__register__(module)
+
     @classmethod
     def default_remaining_stock(cls):
         return 'create_shipment'
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        super().on_modification(mode, records, field_names=field_names)
+        Configuration._remaining_stock_cache.clear()
+
+
+class UpdateSalesRemainingStock(Wizard):
+    "Update Sales Remaining Stock"
+    __name__ = 'party.party.update_sales_remaining_stock'
+    start_state = 'update_sales'
+    update_sales = StateTransition()
+    done = StateView('party.party.update_sales_remaining_stock.done',
+        'sale_remaining_stock.update_sales_remaining_stock_done_view_form', [
+            Button("OK", 'end', 'tryton-ok', default=True),
+            ])
+
+    def transition_update_sales(self):
+        pool = Pool()
+        Party = pool.get('party.party')
+        self.done.updated = sum(
+            Party.update_sales_remaining_stock(self.records).values())
+        return 'done'
+
+    def default_done(self, fields):
+        return {
+            'updated': self.done.updated,
+            }
+
+
+class UpdateSalesRemainingStockDone(ModelView):
+    "Update Sales Remaining Stock"
+    __name__ = 'party.party.update_sales_remaining_stock.done'
+    updated = fields.Integer("Updated Sales", readonly=True,
+        help="The number of draft and quotation sales updated.")
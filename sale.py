@@ -1,10 +1,49 @@
 #The COPYRIGHT file at the top level of this repository contains the full
 #copyright notices and license terms.
-from trytond.model import fields
+import csv
+import hashlib
+import logging
+from collections import defaultdict
+from contextlib import nullcontext
+from itertools import groupby
+from operator import itemgetter
+
+from sql import Literal, Null
+from sql.aggregate import Count, Max, Min, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp
+from sql.operators import Concat, Exists
+
+from trytond import backend, config
+from trytond.model import Index, ModelSQL, ModelView, fields
+from trytond.model.modelsql import convert_from
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
+from trytond.tools import grouped_slice
 from trytond.transaction import Transaction
 
+from .stats import instrumented, phase, profile
+
+logger = logging.getLogger(__name__)
+
+
+def reconcile_on_event():
+    "Return if the remaining stock is reconciled on shipment events"
+    return config.getboolean(
+        'sale_remaining_stock', 'reconcile_on_event', default=False)
+
+
+def process_chunk_size():
+    "Return the maximal number of sales reconciled at once"
+    return config.getint(
+        'sale_remaining_stock', 'process_chunk_size', default=1000)
+
+
+def defer_moves_ignored():
+    "Return if the ignored moves are added by a queued task"
+    return config.getboolean(
+        'sale_remaining_stock', 'defer_moves_ignored', default=False)
+
 
 class Sale(metaclass=PoolMeta):
     __name__ = 'sale.sale'
@@ -15,46 +54,798 @@ class Sale(metaclass=PoolMeta):
         states={
             'readonly': ~Eval('state').in_(['draft', 'quotation']),
             }, help='Allow create new pending shipments to delivery')
+    has_closed_shipment = fields.Function(fields.Boolean(
+            "Has Closed Shipment"), 'get_has_closed_shipment')
+    has_dropped_remaining_stock = fields.Function(fields.Boolean(
+            "Has Dropped Remaining Stock",
+            help="The manual remaining stock has ignored moves."),
+        'get_has_dropped_remaining_stock',
+        searcher='search_has_dropped_remaining_stock')
+    remaining_stock_warehouses = fields.One2Many(
+        'sale.sale.remaining_stock.warehouse', 'sale',
+        "Remaining Stock Warehouses", readonly=True)
+    remaining_stock_fingerprint = fields.Char(
+        "Remaining Stock Fingerprint", readonly=True,
+        help="The fingerprint of the shipments and moves "
+        "at the last reconciliation of the remaining stock.")
 
     @classmethod
+    @instrumented('sale.sale.default_remaining_stock')
     def default_remaining_stock(cls):
         Configuration = Pool().get('sale.configuration')
 
-        config = Configuration(1)
-        return config.remaining_stock or 'create_shipment'
+        return Configuration.get_remaining_stock()
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Party = pool.get('party.party')
+        vlist = [v.copy() for v in vlist]
+
+        # Resolve the policy of the parties when it is not set like
+        # on_change_party would do
+        companies = defaultdict(list)
+        default_company = cls.default_company()
+        for values in vlist:
+            if 'remaining_stock' not in values and values.get('party'):
+                companies[values.get('company', default_company)].append(
+                    values)
+        for company, company_vlist in companies.items():
+            policies = Party.resolve_remaining_stock(
+                Party.browse({v['party'] for v in company_vlist}),
+                company=company)
+            for values in company_vlist:
+                values['remaining_stock'] = policies[values['party']]
+        return super().create(vlist)
 
     @fields.depends('party', 'shipment_party', 'payment_term')
+    @instrumented('sale.sale.on_change_party')
     def on_change_party(self):
         super(Sale, self).on_change_party()
         Configuration = Pool().get('sale.configuration')
 
-        config = Configuration(1)
-        remaining_stock = config.remaining_stock or 'create_shipment'
-        self.remaining_stock = remaining_stock
+        self.remaining_stock = Configuration.get_remaining_stock(self.party)
+
+    @classmethod
+    def _get_shipment_out_query(cls):
+        "Return the tables and the join of the lines with their shipments"
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        Move = pool.get('stock.move')
+        ShipmentOut = pool.get('stock.shipment.out')
+        line = SaleLine.__table__()
+        move = Move.__table__()
+        shipment = ShipmentOut.__table__()
 
-        if self.party:
-            self.remaining_stock = (self.party.remaining_stock
-                if self.party.remaining_stock else remaining_stock)
+        query = (line
+            .join(move, condition=(
+                    move.origin == Concat('sale.line,', line.id)))
+            .join(shipment, condition=(
+                    move.shipment == Concat(
+                        'stock.shipment.out,', shipment.id))))
+        return query, line, move, shipment
 
-    def create_shipment(self, shipment_type):
+    @classmethod
+    def get_has_closed_shipment(cls, sales, name):
+        cursor = Transaction().connection.cursor()
+        query, line, _, shipment = cls._get_shipment_out_query()
+
+        result = dict.fromkeys(map(int, sales), False)
+        for sub_ids in grouped_slice(list(result), backend.MAX_QUERY_PARAMS):
+            cursor.execute(*query.select(
+                    line.sale,
+                    where=(fields.SQL_OPERATORS['in'](line.sale, sub_ids)
+                        & shipment.state.in_(['done', 'cancelled'])),
+                    group_by=[line.sale]))
+            for sale_id, in cursor:
+                result[sale_id] = True
+        return result
+
+    @classmethod
+    def _has_dropped_remaining_stock_condition(cls, sale):
+        "Return the condition of the manual sales with ignored moves"
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        LineIgnored = pool.get('sale.line-ignored-stock.move')
+        line = SaleLine.__table__()
+        ignored = LineIgnored.__table__()
+
+        return ((sale.remaining_stock == 'manual')
+            & Exists(line
+                .join(ignored, condition=ignored.sale_line == line.id)
+                .select(line.id, where=line.sale == sale.id)))
+
+    @classmethod
+    def get_has_dropped_remaining_stock(cls, sales, name):
+        cursor = Transaction().connection.cursor()
+        sale = cls.__table__()
+        condition = cls._has_dropped_remaining_stock_condition(sale)
+
+        result = dict.fromkeys(map(int, sales), False)
+        for sub_ids in grouped_slice(list(result), backend.MAX_QUERY_PARAMS):
+            cursor.execute(*sale.select(
+                    sale.id,
+                    where=(fields.SQL_OPERATORS['in'](sale.id, sub_ids)
+                        & condition)))
+            for sale_id, in cursor:
+                result[sale_id] = True
+        return result
+
+    @classmethod
+    def search_has_dropped_remaining_stock(cls, name, clause):
+        _, operator, value = clause
+        sale = cls.__table__()
+        query = sale.select(
+            sale.id,
+            where=cls._has_dropped_remaining_stock_condition(sale))
+        if (operator == '=') == bool(value):
+            return [('id', 'in', query)]
+        return [('id', 'not in', query)]
+
+    @classmethod
+    def _get_remaining_stock_sales(cls, name, values):
+        """
+        Return the ids of the manual remaining stock sales having moves with
+        the column name in values
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+        SaleLine = pool.get('sale.line')
+        cursor = Transaction().connection.cursor()
+        sale = cls.__table__()
+        line = SaleLine.__table__()
+        move = Move.__table__()
+
+        sale_ids = set()
+        for sub_values in grouped_slice(values, backend.MAX_QUERY_PARAMS):
+            # Join the lines on their primary key from the moves
+            cursor.execute(*move
+                .join(line, condition=(
+                        line.id == Move.origin.sql_id(move.origin, SaleLine)))
+                .join(sale, condition=line.sale == sale.id)
+                .select(
+                    sale.id,
+                    where=(fields.SQL_OPERATORS['in'](
+                            getattr(move, name), list(sub_values))
+                        & move.origin.like('sale.line,%')
+                        & (sale.remaining_stock == 'manual')),
+                    group_by=[sale.id]))
+            sale_ids.update(s for s, in cursor)
+        return list(sale_ids)
+
+    @classmethod
+    def _get_remaining_stock_shipment_ids(cls, sale_ids):
+        "Return the ids of the customer shipments of the sales"
+        cursor = Transaction().connection.cursor()
+        query, line, _, shipment = cls._get_shipment_out_query()
+
+        shipment_ids = set()
+        for sub_ids in grouped_slice(sale_ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*query.select(
+                    shipment.id,
+                    where=fields.SQL_OPERATORS['in'](line.sale, list(sub_ids)),
+                    group_by=[shipment.id]))
+            shipment_ids.update(s for s, in cursor)
+        return list(shipment_ids)
+
+    @classmethod
+    def on_modification(cls, mode, sales, field_names=None):
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        super().on_modification(mode, sales, field_names=field_names)
+        if mode == 'write' and 'remaining_stock' in field_names:
+            sale_ids = [s.id for s in sales]
+            cls._update_remaining_stock_warehouses(sale_ids)
+            ShipmentOut._update_remaining_stock(
+                cls._get_remaining_stock_shipment_ids(sale_ids))
+            cls._set_remaining_stock_fingerprints(
+                dict.fromkeys(sale_ids))
+
+    @classmethod
+    def copy(cls, sales, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('remaining_stock_fingerprint', None)
+        return super().copy(sales, default=default)
+
+    @classmethod
+    def _update_remaining_stock_warehouses(cls, sale_ids):
+        "Update the remaining stock warehouses summary of the sales"
+        pool = Pool()
+        Warehouse = pool.get('sale.sale.remaining_stock.warehouse')
         transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = Warehouse.__table__()
+        sale = cls.__table__()
+        query, line, _, shipment = cls._get_shipment_out_query()
 
-        shipments = self.shipments
+        closed = Case(
+            (shipment.state.in_(['done', 'cancelled']), 1), else_=0)
+        for sub_ids in grouped_slice(sale_ids, backend.MAX_QUERY_PARAMS):
+            sub_ids = list(sub_ids)
+            cursor.execute(*table.delete(
+                    where=fields.SQL_OPERATORS['in'](table.sale, sub_ids)))
+            cursor.execute(*table.insert(
+                    columns=[
+                        table.sale, table.warehouse, table.closed,
+                        table.pending, table.create_uid, table.create_date,
+                        ],
+                    values=query
+                    .join(sale, condition=line.sale == sale.id)
+                    .select(
+                        line.sale, shipment.warehouse,
+                        Max(closed) == 1, Min(closed) == 0,
+                        Literal(transaction.user), CurrentTimestamp(),
+                        where=(fields.SQL_OPERATORS['in'](line.sale, sub_ids)
+                            & (sale.remaining_stock == 'manual')),
+                        group_by=[line.sale, shipment.warehouse])))
+
+    @instrumented('sale.sale.create_shipment')
+    def create_shipment(self, shipment_type):
+        transaction = Transaction()
 
         # if remaining_stock == manual, not grouping new shipments in case
         # has done or cancelled shipments
-        skip_grouping = (self.remaining_stock == 'manual' and shipments
-            and any(s for s in self.shipments if s.state in ('done', 'cancelled')))
+        with phase('skip_grouping', [self]):
+            skip_grouping = (self.remaining_stock == 'manual'
+                and self.has_closed_shipment)
         with transaction.set_context(skip_grouping=skip_grouping):
             return super().create_shipment(shipment_type)
 
     @classmethod
+    @instrumented('sale.sale._process_fulfillment')
     def _process_fulfillment(cls, sales):
+        top = Transaction().context.get('remaining_stock_profile')
+        if top:
+            profiling = profile(10 if top is True else int(top))
+        else:
+            profiling = nullcontext()
+        with profiling:
+            super()._process_fulfillment(sales)
+            # On event, the remaining stock is reconciled by the closing of
+            # the shipments
+            if not reconcile_on_event():
+                # When profiling, reconcile each sale alone to attribute the
+                # costs to it
+                cls._reconcile_remaining_stock(
+                    sales, fingerprint=True, size=1 if top else None)
+
+    @classmethod
+    def _get_remaining_stock_fingerprints(cls, sale_ids):
+        """
+        Return the fingerprint of the moves and customer shipments of each
+        sale
+        """
         pool = Pool()
         SaleLine = pool.get('sale.line')
+        Move = pool.get('stock.move')
         ShipmentOut = pool.get('stock.shipment.out')
+        LineIgnored = pool.get('sale.line-ignored-stock.move')
+        cursor = Transaction().connection.cursor()
+        line = SaleLine.__table__()
+        move = Move.__table__()
+        shipment = ShipmentOut.__table__()
+        ignored = LineIgnored.__table__()
+
+        rows = {s: [] for s in sale_ids}
+        for sub_ids in grouped_slice(sale_ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*line
+                .join(move, condition=(
+                        move.origin == Concat('sale.line,', line.id)))
+                .join(shipment, 'LEFT', condition=(
+                        move.shipment == Concat(
+                            'stock.shipment.out,', shipment.id)))
+                .join(ignored, 'LEFT', condition=(
+                        (ignored.sale_line == line.id)
+                        & (ignored.move == move.id)))
+                .select(
+                    line.sale, move.state, shipment.state,
+                    shipment.warehouse, shipment.remaining_stock,
+                    Count(move.id), Count(ignored.id),
+                    Max(Coalesce(move.write_date, move.create_date)),
+                    Max(Coalesce(shipment.write_date, shipment.create_date)),
+                    where=fields.SQL_OPERATORS['in'](line.sale, list(sub_ids)),
+                    group_by=[
+                        line.sale, move.state, shipment.state,
+                        shipment.warehouse, shipment.remaining_stock]))
+            for sale_id, *values in cursor:
+                rows[sale_id].append(repr(values))
+        return {
+            s: hashlib.sha1('\n'.join(sorted(r)).encode()).hexdigest()
+            for s, r in rows.items()}
+
+    @classmethod
+    def _get_remaining_stock_changed(cls, sales):
+        """
+        Return the manual remaining stock sales whose moves or customer
+        shipments changed since their last reconciliation
+        """
+        cursor = Transaction().connection.cursor()
+        sale = cls.__table__()
+
+        fingerprints = cls._get_remaining_stock_fingerprints(
+            cls._get_remaining_stock_manual_ids(sales))
+        for sub_ids in grouped_slice(
+                list(fingerprints), backend.MAX_QUERY_PARAMS):
+            cursor.execute(*sale.select(
+                    sale.id, sale.remaining_stock_fingerprint,
+                    where=fields.SQL_OPERATORS['in'](sale.id, list(sub_ids))))
+            for sale_id, fingerprint in cursor:
+                if fingerprints[sale_id] == fingerprint:
+                    del fingerprints[sale_id]
+        return [s for s in sales if s.id in fingerprints]
+
+    @classmethod
+    def _set_remaining_stock_fingerprints(cls, fingerprints):
+        "Store the fingerprint of each sale id"
+        cursor = Transaction().connection.cursor()
+        sale = cls.__table__()
+
+        sale_ids = defaultdict(list)
+        for sale_id, fingerprint in fingerprints.items():
+            sale_ids[fingerprint].append(sale_id)
+        for fingerprint, ids in sale_ids.items():
+            for sub_ids in grouped_slice(ids, backend.MAX_QUERY_PARAMS):
+                cursor.execute(*sale.update(
+                        [sale.remaining_stock_fingerprint],
+                        [fingerprint if fingerprint is not None else Null],
+                        where=fields.SQL_OPERATORS['in'](
+                            sale.id, list(sub_ids))))
+
+    @classmethod
+    def _reconcile_remaining_stock(
+            cls, sales, dry_run=False, shipments=None, fingerprint=False,
+            size=None):
+        """
+        Cancel the pending shipments and ignore the cancelled moves of the
+        manual remaining stock sales by chunks of size
 
-        super()._process_fulfillment(sales)
+        The shipments to cancel of all the chunks are locked at once before
+        changing any chunk.
+        If shipments is set, only their warehouses and the moves of these and
+        of the cancelled shipments are reconciled.
+        If fingerprint is set, only the sales whose fingerprint changed are
+        reconciled and their new fingerprint is stored.
+        Return the number of shipments to cancel and of sales to ignore.
+        """
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        if size is None:
+            size = process_chunk_size()
+
+        # Only the ids are kept between the chunks
+        chunks, cancel_ids = [], set()
+        for sub_sales in grouped_slice(sales, size):
+            sub_sales = list(sub_sales)
+            if fingerprint:
+                with phase('fingerprint', sub_sales):
+                    sub_sales = cls._get_remaining_stock_changed(sub_sales)
+            sub_cancel, sub_ignore = cls._get_remaining_stock_manual(
+                sub_sales, shipments=shipments)
+            sub_cancel_ids = [s.id for s in sub_cancel]
+            cancel_ids.update(sub_cancel_ids)
+            chunks.append((
+                    [s.id for s in sub_sales], sub_cancel_ids,
+                    [s.id for s in sub_ignore]))
+        n_ignore = sum(len(i) for _, _, i in chunks)
+        if dry_run:
+            return len(cancel_ids), n_ignore
+
+        defer = defer_moves_ignored()
+        if cancel_ids and not defer:
+            ShipmentOut.lock(ShipmentOut.browse(list(cancel_ids)))
+        for sale_ids, sub_cancel_ids, ignore_ids in chunks:
+            if defer:
+                # The cancellation is deferred with the moves to ignore to
+                # never leave cancelled moves which are not ignored
+                if ignore_ids:
+                    with phase('moves_ignored', ignore_ids):
+                        cls._defer_remaining_stock_moves_ignored(
+                            cls.browse(ignore_ids),
+                            ShipmentOut.browse(sub_cancel_ids),
+                            shipments=shipments)
+                continue
+
+            # cancel customer shipments
+            if sub_cancel_ids:
+                with phase('cancellation', sale_ids):
+                    cls._cancel_remaining_stock_shipments(
+                        ShipmentOut.browse(sub_cancel_ids))
+
+            if ignore_ids:
+                sub_ignore = cls.browse(ignore_ids)
+                sub_shipments = shipments
+                if shipments is not None:
+                    sub_shipments = (list(shipments)
+                        + list(ShipmentOut.browse(sub_cancel_ids)))
+                with phase('moves_ignored', sub_ignore):
+                    cls._add_remaining_stock_moves_ignored(
+                        sub_ignore, shipments=sub_shipments)
+
+        if fingerprint:
+            # The fingerprints are computed once all the chunks are changed
+            # as they may share shipments
+            for sale_ids, _, _ in chunks:
+                with phase('fingerprint', sale_ids):
+                    cls._set_remaining_stock_fingerprints(
+                        cls._get_remaining_stock_fingerprints(sale_ids))
+        return len(cancel_ids), n_ignore
+
+    @classmethod
+    def reconcile_remaining_stock_shipments(cls, shipments):
+        "Reconcile the remaining stock of the sales of the closed shipments"
+        sale_ids = cls._get_remaining_stock_sales(
+            'shipment', [str(s) for s in shipments])
+        if not sale_ids:
+            return
+        sales = cls.browse(sale_ids)
+        cls.lock(sales)
+        n_cancel, n_ignore = cls._reconcile_remaining_stock(
+            sales, shipments=shipments)
+        if n_cancel or n_ignore:
+            cls.__queue__.process(sales)
+
+    @classmethod
+    def reconcile_remaining_stock(cls, dry_run=False):
+        """
+        Queue the reconciliation of the open manual remaining stock sales
+        having a pending shipment in a closed warehouse
+
+        The sales are partitioned by company and warehouse and each chunk of
+        a partition is processed by a queue task in its own transaction.
+        Return the sale ids per partition.
+        """
+        pool = Pool()
+        Warehouse = pool.get('sale.sale.remaining_stock.warehouse')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        sale = cls.__table__()
+        warehouse = Warehouse.__table__()
+
+        where = (sale.state.in_(['confirmed', 'processing'])
+            & (sale.remaining_stock == 'manual')
+            & (warehouse.closed == Literal(True))
+            & (warehouse.pending == Literal(True)))
+        company = transaction.context.get('company')
+        if company is not None:
+            where &= sale.company == company
+        cursor.execute(*warehouse
+            .join(sale, condition=warehouse.sale == sale.id)
+            .select(
+                sale.company, Min(warehouse.warehouse), sale.id,
+                where=where,
+                group_by=[sale.company, sale.id],
+                order_by=[sale.company, Min(warehouse.warehouse), sale.id]))
+
+        partitions = {}
+        for key, rows in groupby(cursor, key=itemgetter(0, 1)):
+            partitions[key] = [s for _, _, s in rows]
+
+        for (company, _), sale_ids in partitions.items():
+            with transaction.set_context(company=company, queue_batch=False):
+                for sub_ids in grouped_slice(sale_ids, process_chunk_size()):
+                    cls.__queue__.reconcile_remaining_stock_partition(
+                        cls.browse(list(sub_ids)), dry_run=dry_run)
+        return partitions
+
+    @classmethod
+    def reconcile_remaining_stock_partition(cls, sales, dry_run=False):
+        """
+        Reconcile the remaining stock of a partition of sales
+
+        Return the number of shipments to cancel and of sales to ignore.
+        """
+        if not dry_run:
+            cls.lock(sales)
+        n_cancel, n_ignore = cls._reconcile_remaining_stock(
+            sales, dry_run=dry_run)
+        logger.info(
+            "%s remaining stock of %d sales: %d shipments to cancel, "
+            "%d sales to ignore moves",
+            "Dry-run" if dry_run else "Reconciled",
+            len(sales), n_cancel, n_ignore)
+        return n_cancel, n_ignore
+
+    @classmethod
+    def _get_remaining_stock_manual_ids(cls, sales):
+        "Return the ids of the sales with manual remaining stock"
+        cursor = Transaction().connection.cursor()
+        sale = cls.__table__()
+
+        sale_ids = []
+        for sub_ids in grouped_slice(
+                list(map(int, sales)), backend.MAX_QUERY_PARAMS):
+            cursor.execute(*sale.select(
+                    sale.id,
+                    where=(fields.SQL_OPERATORS['in'](sale.id, list(sub_ids))
+                        & (sale.remaining_stock == 'manual'))))
+            sale_ids.extend(s for s, in cursor)
+        return sale_ids
+
+    @classmethod
+    def _get_remaining_stock_manual(cls, sales, shipments=None):
+        """
+        Return the customer shipments to cancel and the sales whose cancelled
+        moves must be ignored for the sales with manual remaining stock
+
+        If shipments is set, only their warehouses are considered as closed.
+        """
+        pool = Pool()
+        Warehouse = pool.get('sale.sale.remaining_stock.warehouse')
+        ShipmentOut = pool.get('stock.shipment.out')
+        transaction = Transaction()
+        query, line, _, shipment = cls._get_shipment_out_query()
+        warehouse = Warehouse.__table__()
+
+        sale_ids = cls._get_remaining_stock_manual_ids(sales)
+        if not sale_ids:
+            return [], []
+
+        with phase('closed_warehouses', sale_ids):
+            cursor = transaction.connection.cursor()
+            closed_warehouses = defaultdict(set)
+            pending_ids = set()
+            for sub_ids in grouped_slice(sale_ids, backend.MAX_QUERY_PARAMS):
+                where = (fields.SQL_OPERATORS['in'](warehouse.sale, sub_ids)
+                    & (warehouse.closed == Literal(True)))
+                if shipments is not None:
+                    where &= warehouse.warehouse.in_(
+                        list({s.warehouse.id for s in shipments}))
+                cursor.execute(*warehouse.select(
+                        warehouse.sale, warehouse.warehouse,
+                        warehouse.pending,
+                        where=where))
+                for sale_id, warehouse_id, pending in cursor:
+                    closed_warehouses[sale_id].add(warehouse_id)
+                    if pending:
+                        pending_ids.add(sale_id)
+
+        with phase('policy_check', sale_ids):
+            cursor = transaction.connection.cursor()
+            sale_shipments = defaultdict(set)
+            for sub_ids in grouped_slice(
+                    list(pending_ids), backend.MAX_QUERY_PARAMS):
+                cursor.execute(*query.select(
+                        line.sale, shipment.id, shipment.state,
+                        shipment.warehouse, shipment.remaining_stock,
+                        where=fields.SQL_OPERATORS['in'](line.sale, sub_ids),
+                        group_by=[
+                            line.sale, shipment.id, shipment.state,
+                            shipment.warehouse, shipment.remaining_stock]))
+                for sale_id, *values in cursor:
+                    sale_shipments[sale_id].add(tuple(values))
+
+            to_check = {}
+            to_ignore = []
+            for sale_id in sale_ids:
+                if sale_id not in closed_warehouses:
+                    continue
+                if sale_id not in pending_ids:
+                    to_ignore.append(sale_id)
+                    continue
+                to_check[sale_id] = [
+                    s for s, state, w, _ in sale_shipments[sale_id]
+                    if (state not in {'cancelled', 'done'}
+                        and w in closed_warehouses[sale_id])]
+
+            to_cancel = []
+            for sale_id, cancel_ids in to_check.items():
+                # Cancel if all outgoing moves are linked to sales where
+                # remaining_stock == 'manual'
+                remaining_stock = set()
+                for _, _, _, policy in sale_shipments[sale_id]:
+                    if policy is not None:
+                        remaining_stock.add(policy)
+                    if 'mixed' in remaining_stock or len(remaining_stock) > 1:
+                        break
+                if 'mixed' in remaining_stock or len(remaining_stock) != 1:
+                    continue
+                to_cancel.extend(cancel_ids)
+                to_ignore.append(sale_id)
+
+        to_ignore = set(to_ignore)
+        return (ShipmentOut.browse(sorted(set(to_cancel))),
+            [s for s in sales if s.id in to_ignore])
+
+    @classmethod
+    def _cancel_remaining_stock_shipments(cls, shipments):
+        """
+        Cancel the customer shipments per warehouse by chunks, skipping those
+        already closed by another transaction
+
+        The shipments must be locked by the caller.
+        """
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        cursor = Transaction().connection.cursor()
+        table = ShipmentOut.__table__()
+        size = config.getint(
+            'sale_remaining_stock', 'cancel_batch_size', default=100)
+
+        shipment_ids = list({s.id for s in shipments})
+        to_cancel = []
+        for sub_ids in grouped_slice(shipment_ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*table.select(
+                    table.warehouse, table.id,
+                    where=(fields.SQL_OPERATORS['in'](table.id, list(sub_ids))
+                        & ~table.state.in_(['cancelled', 'done']))))
+            to_cancel.extend(cursor)
+        to_cancel.sort()
+
+        for _, warehouse_shipments in groupby(to_cancel, key=itemgetter(0)):
+            for sub_shipments in grouped_slice(
+                    [s for _, s in warehouse_shipments], size):
+                ShipmentOut.cancel(ShipmentOut.browse(list(sub_shipments)))
+
+    @classmethod
+    def _get_remaining_stock_moves_ignored_query(cls):
+        """
+        Return the query, the condition and the tables of the lines with
+        their cancelled moves which are not yet ignored or recreated
+        """
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        Move = pool.get('stock.move')
+        LineIgnored = pool.get('sale.line-ignored-stock.move')
+        LineRecreated = pool.get('sale.line-recreated-stock.move')
+        line = SaleLine.__table__()
+        move = Move.__table__()
+        ignored = LineIgnored.__table__()
+        recreated = LineRecreated.__table__()
+
+        query = (line
+            .join(move, condition=(
+                    move.origin == Concat('sale.line,', line.id)))
+            .join(ignored, 'LEFT', condition=(
+                    (ignored.sale_line == line.id)
+                    & (ignored.move == move.id)))
+            .join(recreated, 'LEFT', condition=(
+                    (recreated.sale_line == line.id)
+                    & (recreated.move == move.id))))
+        where = ((move.state == 'cancelled')
+            & (ignored.id == Null)
+            & (recreated.id == Null))
+        return query, where, line, move
+
+    @classmethod
+    def _add_remaining_stock_moves_ignored(cls, sales, shipments=None):
+        """
+        Add the cancelled moves of the sales lines to the ignored moves
+
+        If shipments is set, only their moves are ignored.
+        """
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        LineIgnored = pool.get('sale.line-ignored-stock.move')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        ignored_insert = LineIgnored.__table__()
+        query, where, line, move = (
+            cls._get_remaining_stock_moves_ignored_query())
+
+        if shipments is not None:
+            where &= move.shipment.in_([str(s) for s in shipments])
+        for sub_sales in grouped_slice(sales, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*ignored_insert.insert(
+                    columns=[
+                        ignored_insert.sale_line, ignored_insert.move,
+                        ignored_insert.create_uid, ignored_insert.create_date,
+                        ],
+                    values=query.select(
+                        line.id, move.id,
+                        Literal(transaction.user), CurrentTimestamp(),
+                        where=(where
+                            & fields.SQL_OPERATORS['in'](
+                                line.sale, [s.id for s in sub_sales])))))
+
+        transaction.counter += 1
+        for cache in transaction.cache.values():
+            if SaleLine.__name__ in cache:
+                cache[SaleLine.__name__].clear()
+
+    @classmethod
+    def _defer_remaining_stock_moves_ignored(
+            cls, sales, to_cancel, shipments=None):
+        """
+        Queue the cancellation of the customer shipments and the addition of
+        the cancelled moves of the sales lines to the ignored moves by batches
+        of moves
+
+        The moves of a sale are never split between batches.
+        If shipments is set, only the moves of these and of the shipments to
+        cancel are ignored.
+        """
+        cursor = Transaction().connection.cursor()
+        query, where, line, move = (
+            cls._get_remaining_stock_moves_ignored_query())
+        shipment_query, shipment_line, shipment_move, shipment = (
+            cls._get_shipment_out_query())
+        size = config.getint(
+            'sale_remaining_stock', 'moves_ignored_batch_size', default=1000)
+
+        cancel_ids = [s.id for s in to_cancel]
+        shipment_ids = None
+        if shipments is not None:
+            shipment_ids = [s.id for s in shipments]
+            where &= move.shipment.in_(
+                ['stock.shipment.out,%s' % i
+                    for i in shipment_ids + cancel_ids])
+        counts = defaultdict(int)
+        sale_cancel_ids = defaultdict(set)
+        for sub_sales in grouped_slice(sales, backend.MAX_QUERY_PARAMS):
+            sub_ids = [s.id for s in sub_sales]
+            cursor.execute(*query.select(
+                    line.sale, Count(move.id),
+                    where=(where
+                        & fields.SQL_OPERATORS['in'](line.sale, sub_ids)),
+                    group_by=[line.sale]))
+            for sale_id, count in cursor:
+                counts[sale_id] += count
+            for sub_cancel_ids in grouped_slice(
+                    cancel_ids, backend.MAX_QUERY_PARAMS):
+                cursor.execute(*shipment_query.select(
+                        shipment_line.sale, shipment.id,
+                        Count(shipment_move.id),
+                        where=(fields.SQL_OPERATORS['in'](
+                                shipment_line.sale, sub_ids)
+                            & fields.SQL_OPERATORS['in'](
+                                shipment.id, list(sub_cancel_ids))
+                            & ~shipment_move.state.in_(
+                                ['cancelled', 'done'])),
+                        group_by=[shipment_line.sale, shipment.id]))
+                for sale_id, shipment_id, count in cursor:
+                    counts[sale_id] += count
+                    sale_cancel_ids[sale_id].add(shipment_id)
+
+        def queue(sale_ids, cancel_ids):
+            cls.__queue__.apply_remaining_stock_moves_ignored(
+                cls.browse(sale_ids), sorted(cancel_ids), shipment_ids)
+
+        sale_ids, batch_cancel_ids, batch_size = [], set(), 0
+        for sale in sales:
+            count = counts[sale.id]
+            if not count:
+                continue
+            if sale_ids and batch_size + count > size:
+                queue(sale_ids, batch_cancel_ids)
+                sale_ids, batch_cancel_ids, batch_size = [], set(), 0
+            sale_ids.append(sale.id)
+            batch_cancel_ids |= sale_cancel_ids[sale.id]
+            batch_size += count
+        if sale_ids:
+            queue(sale_ids, batch_cancel_ids)
+
+    @classmethod
+    def apply_remaining_stock_moves_ignored(
+            cls, sales, cancel_ids, shipment_ids=None):
+        """
+        Cancel the customer shipments, add the cancelled moves of the sales
+        lines to the ignored moves and process the sales
+
+        cancel_ids is the list of the ids of the shipments to cancel.
+        If shipment_ids is set, only the moves of these and of the shipments
+        to cancel are ignored.
+        """
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        cls.lock(sales)
+        to_cancel = ShipmentOut.browse(cancel_ids)
+        if to_cancel:
+            ShipmentOut.lock(to_cancel)
+            cls._cancel_remaining_stock_shipments(to_cancel)
+        shipments = None
+        if shipment_ids is not None:
+            shipments = ShipmentOut.browse(shipment_ids + cancel_ids)
+        cls._add_remaining_stock_moves_ignored(sales, shipments=shipments)
+        cls.__queue__.process(sales)
+
+    @classmethod
+    def _get_remaining_stock_manual_reference(cls, sales):
+        "Reference implementation of _get_remaining_stock_manual"
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
 
         to_ignore = []
         to_cancel = []
@@ -84,25 +875,162 @@ class Sale(metaclass=PoolMeta):
 
                     to_cancel += shipments
                 to_ignore.append(sale)
+        return to_cancel, to_ignore
 
-        # cancel customer shipments
-        if to_cancel:
-            ShipmentOut.cancel(to_cancel)
-
-        if to_ignore:
-            to_write = []
-            for sale in to_ignore:
-                for line in sale.lines:
-                    moves = []
-                    skips = set(line.moves_ignored)
-                    skips.update(line.moves_recreated)
-                    for move in line.moves:
-                        if move.state == 'cancelled' and move not in skips:
-                            moves.append(move.id)
-                    if not moves:
-                        continue
-                    to_write.extend(([line], {
-                            'moves_ignored': [('add', moves)],
-                            }))
-            if to_write:
-                SaleLine.write(*to_write)
+
+class SaleRemainingStockWarehouse(ModelSQL):
+    "Sale Remaining Stock Warehouse"
+    __name__ = 'sale.sale.remaining_stock.warehouse'
+    sale = fields.Many2One(
+        'sale.sale', "Sale", required=True, ondelete='CASCADE')
+    warehouse = fields.Many2One(
+        'stock.location', "Warehouse", ondelete='CASCADE')
+    closed = fields.Boolean(
+        "Closed", help="The sale has a done or cancelled shipment "
+        "in the warehouse.")
+    pending = fields.Boolean(
+        "Pending", help="The sale has an open shipment in the warehouse.")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls.__access__.add('sale')
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.sale, Index.Equality()),
+                    (t.warehouse, Index.Equality())),
+                Index(t,
+                    (t.sale, Index.Range()),
+                    where=(t.closed == Literal(True))
+                    & (t.pending == Literal(True))),
+                })
+
+    @classmethod
+    def __register__(cls, module):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        cursor = Transaction().connection.cursor()
+        sale = Sale.__table__()
+        created = not backend.TableHandler.table_exist(cls._table)
+
+        super().__register__(module)
+
+        if created:
+            cursor.execute(*sale.select(
+                    sale.id, where=sale.remaining_stock == 'manual'))
+            Sale._update_remaining_stock_warehouses([s for s, in cursor])
+
+
+class SaleRemainingStockBacklog(ModelSQL, ModelView):
+    "Sale Remaining Stock Backlog"
+    __name__ = 'sale.remaining_stock.backlog'
+    company = fields.Many2One('company.company', "Company", readonly=True)
+    warehouse = fields.Many2One('stock.location', "Warehouse", readonly=True)
+    product = fields.Many2One(
+        'product.product', "Product", readonly=True,
+        context={
+            'company': Eval('company', -1),
+            },
+        depends=['company'])
+    quantity = fields.Float(
+        "Quantity", readonly=True,
+        help="The dropped quantity in the default unit of the product.")
+    moves = fields.Integer("Moves", readonly=True)
+    sales = fields.Integer("Sales", readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('product', 'ASC'))
+        cls._order.insert(1, ('warehouse', 'ASC'))
+
+    @classmethod
+    def table_query(cls):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        Move = pool.get('stock.move')
+        LineIgnored = pool.get('sale.line-ignored-stock.move')
+        ShipmentOut = pool.get('stock.shipment.out')
+        sale = Sale.__table__()
+        line = SaleLine.__table__()
+        move = Move.__table__()
+        ignored = LineIgnored.__table__()
+        shipment = ShipmentOut.__table__()
+
+        return (ignored
+            .join(line, condition=ignored.sale_line == line.id)
+            .join(sale, condition=line.sale == sale.id)
+            .join(move, condition=ignored.move == move.id)
+            .join(shipment, condition=(
+                    move.shipment == Concat(
+                        'stock.shipment.out,', shipment.id)))
+            .select(
+                Min(ignored.id).as_('id'),
+                sale.company.as_('company'),
+                shipment.warehouse.as_('warehouse'),
+                move.product.as_('product'),
+                Sum(move.internal_quantity).as_('quantity'),
+                Count(move.id, distinct=True).as_('moves'),
+                Count(sale.id, distinct=True).as_('sales'),
+                where=((sale.remaining_stock == 'manual')
+                    & (move.state == 'cancelled')),
+                group_by=[sale.company, shipment.warehouse, move.product]))
+
+    @classmethod
+    def write_csv(cls, file, domain=None, size=1000):
+        """
+        Write the backlog matching the domain as CSV to the file
+
+        The rows are fetched by chunks of size to keep the memory bounded.
+        """
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        Rule = pool.get('ir.rule')
+        connection = Transaction().connection
+        location = Location.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+
+        if domain is None:
+            domain = []
+        # The domain is converted against the same instance of the table
+        # query to compute the aggregate only once
+        tables, expression = cls.search_domain(domain)
+        rule_domain = Rule.domain_get(cls.__name__, mode='read')
+        if rule_domain:
+            tables, rule_expression = cls.search_domain(
+                rule_domain, active_test=False, tables=tables)
+            expression &= rule_expression
+        backlog, _ = tables[None]
+        if backend.name == 'postgresql':
+            # A client-side cursor loads all the rows on execute
+            cursor = connection.cursor('sale_remaining_stock_backlog')
+        else:
+            cursor = connection.cursor()
+        try:
+            cursor.execute(*convert_from(None, tables)
+                .join(location, condition=backlog.warehouse == location.id)
+                .join(product, condition=backlog.product == product.id)
+                .join(template, condition=product.template == template.id)
+                .select(
+                    location.code, location.name, product.code,
+                    template.name, backlog.quantity, backlog.moves,
+                    backlog.sales,
+                    where=expression,
+                    order_by=[product.code, location.code, backlog.id]))
+
+            writer = csv.writer(file)
+            writer.writerow([
+                    'warehouse_code', 'warehouse', 'product_code', 'product',
+                    'quantity', 'moves', 'sales'])
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                writer.writerows(rows)
+        finally:
+            cursor.close()
@@ -0,0 +1,263 @@
+#The COPYRIGHT file at the top level of this repository contains the full
+#copyright notices and license terms.
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, local
+
+from trytond import config
+from trytond.transaction import Transaction
+
+__all__ = ['instrumented', 'get_stats', 'reset_stats', 'profile', 'phase',
+    'get_profile']
+
+logger = logging.getLogger(__name__)
+
+_stats = defaultdict(lambda: {
+        'calls': 0,
+        'queries': 0,
+        'rows': 0,
+        'elapsed': 0.,
+        })
+_stats_lock = Lock()
+_local = local()
+
+
+def is_enabled():
+    "Return if the instrumentation is enabled for the transaction"
+    context = Transaction().context
+    if 'remaining_stock_stats' in context:
+        return bool(context['remaining_stock_stats'])
+    return config.getboolean(
+        'sale_remaining_stock', 'stats', default=False)
+
+
+def get_stats():
+    "Return a copy of the statistics recorded per method name"
+    with _stats_lock:
+        return {k: dict(v) for k, v in _stats.items()}
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+class StatsCounter:
+    "Statements and rows counted on a connection"
+    __slots__ = ('queries', 'rows')
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+
+
+class StatsCursor:
+    "Cursor proxy which counts the executed statements and fetched rows"
+
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return self._cursor.__exit__(type, value, traceback)
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._counter.rows += 1
+            yield row
+
+    def execute(self, *args, **kwargs):
+        self._counter.queries += 1
+        self._cursor.execute(*args, **kwargs)
+        return self
+
+    def executemany(self, *args, **kwargs):
+        self._counter.queries += 1
+        self._cursor.executemany(*args, **kwargs)
+        return self
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._counter.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._counter.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._counter.rows += len(rows)
+        return rows
+
+
+class StatsConnection:
+    "Connection proxy which returns counting cursors"
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.counter = StatsCounter()
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self, *args, **kwargs):
+        return StatsCursor(
+            self._connection.cursor(*args, **kwargs), self.counter)
+
+
+def record(name, queries, rows, elapsed, **extra):
+    "Record the statistics of a call of name"
+    with _stats_lock:
+        stats = _stats[name]
+        stats['calls'] += 1
+        stats['queries'] += queries
+        stats['rows'] += rows
+        stats['elapsed'] += elapsed
+    values = dict(
+        name=name, queries=queries, rows=rows, elapsed=elapsed, **extra)
+    logger.info(
+        "%s: %d queries, %d rows in %.6fs", name, queries, rows, elapsed,
+        extra={'remaining_stock_stats': values})
+
+
+class measure:
+    "Context manager which records the statistics of the enclosed code"
+
+    def __init__(self, name, **extra):
+        self.name = name
+        self.extra = extra
+
+    def __enter__(self):
+        transaction = Transaction()
+        self.connection = None
+        if not isinstance(transaction.connection, StatsConnection):
+            self.connection = transaction.connection
+            transaction.connection = StatsConnection(self.connection)
+        self.counter = transaction.connection.counter
+        self.queries = self.counter.queries
+        self.rows = self.counter.rows
+        self.start = time.perf_counter()
+        return self
+
+    def stop(self):
+        "Restore the connection and return the queries, rows and elapsed"
+        elapsed = time.perf_counter() - self.start
+        if self.connection is not None:
+            Transaction().connection = self.connection
+        return (
+            self.counter.queries - self.queries,
+            self.counter.rows - self.rows,
+            elapsed)
+
+    def __exit__(self, type, value, traceback):
+        record(self.name, *self.stop(), **self.extra)
+
+
+def instrumented(name):
+    "Decorator which records the statistics of the calls when enabled"
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not is_enabled():
+                return func(*args, **kwargs)
+            with measure(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Profile:
+    "Cost of each phase per sale"
+
+    def __init__(self, top):
+        self.top = top
+        self.sales = defaultdict(lambda: defaultdict(lambda: {
+                    'queries': 0,
+                    'rows': 0,
+                    'elapsed': 0.,
+                    }))
+
+    def add(self, sale_ids, name, queries, rows, elapsed):
+        "Add the cost of the phase name shared by the sales"
+        if not sale_ids:
+            return
+        for sale_id in sale_ids:
+            phase = self.sales[sale_id][name]
+            phase['queries'] += queries / len(sale_ids)
+            phase['rows'] += rows / len(sale_ids)
+            phase['elapsed'] += elapsed / len(sale_ids)
+
+    def get_top(self):
+        "Return the most expensive sales with their phases"
+        def elapsed(item):
+            _, phases = item
+            return sum(p['elapsed'] for p in phases.values())
+        return [
+            (sale_id, {k: dict(v) for k, v in phases.items()})
+            for sale_id, phases in sorted(
+                self.sales.items(), key=elapsed, reverse=True)[:self.top]]
+
+    def log(self):
+        for sale_id, phases in self.get_top():
+            logger.info(
+                "sale %d: %s", sale_id,
+                ", ".join(
+                    "%s %d queries, %d rows in %.6fs" % (
+                        name, p['queries'], p['rows'], p['elapsed'])
+                    for name, p in phases.items()),
+                extra={'remaining_stock_profile': {
+                        'sale': sale_id,
+                        'phases': phases,
+                        }})
+
+
+def get_profile():
+    "Return the profile of the current process run or None"
+    return getattr(_local, 'profile', None)
+
+
+@contextmanager
+def profile(top=10):
+    """
+    Profile the phases of the enclosed code per sale
+    and log the top most expensive sales
+    """
+    previous = get_profile()
+    _local.profile = current = Profile(top)
+    try:
+        yield current
+    finally:
+        _local.profile = previous
+        current.log()
+
+
+class phase(measure):
+    "Context manager which adds the cost of the enclosed code to the profile"
+
+    def __init__(self, name, sales):
+        super().__init__(name)
+        self.sales = sales
+
+    def __enter__(self):
+        self.profile = get_profile()
+        if self.profile is not None:
+            super().__enter__()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.profile is not None:
+            self.profile.add(
+                [int(s) for s in self.sales], self.name, *self.stop())
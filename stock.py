@@ -0,0 +1,191 @@
+#The COPYRIGHT file at the top level of this repository contains the full
+#copyright notices and license terms.
+from collections import defaultdict
+
+from sql import Null
+from sql.aggregate import Max, Min
+from sql.operators import Concat
+
+from trytond import backend
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+from .sale import reconcile_on_event
+
+
+class ShipmentOut(metaclass=PoolMeta):
+    __name__ = 'stock.shipment.out'
+    remaining_stock = fields.Selection([
+            (None, ''),
+            ('create_shipment', 'Create Shipment'),
+            ('manual', 'Manual'),
+            ('mixed', "Mixed"),
+            ], "Remaining Stock", readonly=True,
+        help="The remaining stock of the sales of the outgoing moves.")
+
+    @classmethod
+    def __register__(cls, module):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        table_h = cls.__table_handler__(module)
+        created = not table_h.column_exist('remaining_stock')
+
+        super().__register__(module)
+
+        if created:
+            cursor.execute(*table.select(table.id))
+            cls._update_remaining_stock([s for s, in cursor])
+
+    @classmethod
+    def _update_remaining_stock(cls, shipment_ids):
+        "Update the remaining stock of the sales of the outgoing moves"
+        pool = Pool()
+        Move = pool.get('stock.move')
+        SaleLine = pool.get('sale.line')
+        Sale = pool.get('sale.sale')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        shipment = cls.__table__()
+        move = Move.__table__()
+        line = SaleLine.__table__()
+        sale = Sale.__table__()
+
+        if not shipment_ids:
+            return
+        for sub_ids in grouped_slice(
+                list(set(shipment_ids)), backend.MAX_QUERY_PARAMS):
+            sub_ids = list(sub_ids)
+            policies = defaultdict(list)
+            cursor.execute(*shipment
+                .join(move, condition=(
+                        move.shipment == Concat(
+                            'stock.shipment.out,', shipment.id)))
+                .join(line, condition=(
+                        line.id == Move.origin.sql_id(move.origin, SaleLine)))
+                .join(sale, condition=line.sale == sale.id)
+                .select(
+                    shipment.id,
+                    Min(sale.remaining_stock), Max(sale.remaining_stock),
+                    where=(fields.SQL_OPERATORS['in'](shipment.id, sub_ids)
+                        & move.origin.like('sale.line,%')
+                        & ((move.from_location == shipment.warehouse_output)
+                            | (shipment.warehouse_output
+                                == shipment.warehouse_storage))),
+                    group_by=[shipment.id]))
+            for shipment_id, min_policy, max_policy in cursor:
+                policy = min_policy if min_policy == max_policy else 'mixed'
+                policies[policy].append(shipment_id)
+            policies[None] = list(
+                set(sub_ids).difference(*policies.values()))
+
+            for policy, ids in policies.items():
+                if not ids:
+                    continue
+                cursor.execute(*table.update(
+                        [table.remaining_stock],
+                        [policy if policy is not None else Null],
+                        where=fields.SQL_OPERATORS['in'](table.id, ids)))
+
+        transaction.counter += 1
+        for cache in transaction.cache.values():
+            if cls.__name__ in cache:
+                cache[cls.__name__].clear()
+
+    @classmethod
+    def on_modification(cls, mode, shipments, field_names=None):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        super().on_modification(mode, shipments, field_names=field_names)
+        if mode == 'write' and field_names & {
+                'warehouse', 'warehouse_output', 'warehouse_storage'}:
+            cls._update_remaining_stock([s.id for s in shipments])
+        if mode == 'write' and field_names & {'state', 'warehouse'}:
+            sale_ids = Sale._get_remaining_stock_sales(
+                'shipment', [str(s) for s in shipments])
+            Sale._update_remaining_stock_warehouses(sale_ids)
+            if sale_ids and 'state' in field_names and reconcile_on_event():
+                closed = [s for s in shipments
+                    if s.state in {'done', 'cancelled'}]
+                if closed:
+                    cls.__queue__.reconcile_remaining_stock(closed)
+
+    @classmethod
+    def reconcile_remaining_stock(cls, shipments):
+        "Reconcile the remaining stock of the sales of the shipments"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Sale.reconcile_remaining_stock_shipments(shipments)
+
+
+class Move(metaclass=PoolMeta):
+    __name__ = 'stock.move'
+
+    @classmethod
+    def _get_remaining_stock_shipment_ids(cls, moves):
+        "Return the ids of the customer shipments of the moves"
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        return list({m.shipment.id for m in moves
+                if isinstance(m.shipment, ShipmentOut)})
+
+    @classmethod
+    def _get_remaining_stock_sale_ids(cls, moves):
+        "Return the ids of the manual remaining stock sales of the moves"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        move_ids = [m.id for m in moves if isinstance(m.origin, SaleLine)]
+        if not move_ids:
+            return []
+        return Sale._get_remaining_stock_sales('id', move_ids)
+
+    @classmethod
+    def on_modification(cls, mode, moves, field_names=None):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        ShipmentOut = pool.get('stock.shipment.out')
+        super().on_modification(mode, moves, field_names=field_names)
+        if (mode == 'create'
+                or (mode == 'write'
+                    and field_names & {'shipment', 'origin'})):
+            sale_ids = cls._get_remaining_stock_sale_ids(moves)
+            if sale_ids:
+                Sale._update_remaining_stock_warehouses(sale_ids)
+        if (mode == 'create'
+                or (mode == 'write'
+                    and field_names & {
+                        'shipment', 'origin', 'from_location'})):
+            ShipmentOut._update_remaining_stock(
+                cls._get_remaining_stock_shipment_ids(moves))
+
+    @classmethod
+    def on_write(cls, moves, values):
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        callback = super().on_write(moves, values)
+        if values.keys() & {'shipment', 'origin', 'from_location'}:
+            shipment_ids = cls._get_remaining_stock_shipment_ids(moves)
+            if shipment_ids:
+                callback.append(
+                    lambda: ShipmentOut._update_remaining_stock(
+                        shipment_ids))
+        return callback
+
+    @classmethod
+    def on_delete(cls, moves):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        ShipmentOut = pool.get('stock.shipment.out')
+        callback = super().on_delete(moves)
+        sale_ids = cls._get_remaining_stock_sale_ids(moves)
+        if sale_ids:
+            callback.append(
+                lambda: Sale._update_remaining_stock_warehouses(sale_ids))
+        shipment_ids = cls._get_remaining_stock_shipment_ids(moves)
+        if shipment_ids:
+            callback.append(
+                lambda: ShipmentOut._update_remaining_stock(shipment_ids))
+        return callback
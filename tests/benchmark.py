@@ -0,0 +1,265 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Benchmark of the remaining stock processing
+
+It builds a synthetic dataset on the test database and reports the wall
+time percentiles and the number of SQL statements of Sale.process,
+Sale._process_fulfillment, Sale.create_shipment and Sale.on_change_party.
+
+Usage:
+
+    DB_NAME=:memory: TRYTOND_DATABASE_URI=sqlite:// \\
+        python -m trytond.modules.sale_remaining_stock.tests.benchmark \\
+        --sales 10000 --max-lines 500
+"""
+import argparse
+import logging
+import random
+import statistics
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.pool import Pool
+from trytond.tests.test_tryton import CONTEXT, DB_NAME, USER, activate_module
+from trytond.transaction import Transaction
+
+BACKEND_LOGGERS = [
+    'trytond.backend.postgresql.database',
+    'trytond.backend.sqlite.database',
+    ]
+
+
+class QueryCounter(logging.Handler):
+    "Count the SQL statements logged by the backends"
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+    def install(self):
+        for name in BACKEND_LOGGERS:
+            logger = logging.getLogger(name)
+            logger.setLevel(logging.DEBUG)
+            logger.propagate = False
+            logger.addHandler(self)
+
+
+class Stats:
+    "Wall times and statement counts of the calls of a method"
+
+    def __init__(self, name, counter):
+        self.name = name
+        self.counter = counter
+        self.times = []
+        self.queries = []
+
+    @contextmanager
+    def measure(self):
+        count = self.counter.count
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times.append(time.perf_counter() - start)
+            self.queries.append(self.counter.count - count)
+
+    def report(self):
+        if not self.times:
+            return '%-28s %6d' % (self.name, 0)
+        if len(self.times) > 1:
+            p50, p90, p99 = (statistics.quantiles(
+                        self.times, n=100, method='inclusive')[i]
+                for i in (49, 89, 98))
+        else:
+            p50 = p90 = p99 = self.times[0]
+        return ('%-28s %6d %9.3f %9.2f %9.2f %9.2f %9.2f %9.1f %7d' % (
+                self.name, len(self.times), sum(self.times),
+                p50 * 1000, p90 * 1000, p99 * 1000, max(self.times) * 1000,
+                statistics.mean(self.queries), max(self.queries)))
+
+    @staticmethod
+    def header():
+        return '%-28s %6s %9s %9s %9s %9s %9s %9s %7s' % (
+            "method", "calls", "total s", "p50 ms", "p90 ms", "p99 ms",
+            "max ms", "queries", "max q")
+
+
+def create_product():
+    pool = Pool()
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    template, = Template.create([{
+                'name': 'Product',
+                'type': 'goods',
+                'salable': True,
+                'default_uom': unit.id,
+                'sale_uom': unit.id,
+                'list_price': Decimal(10),
+                'products': [('create', [{}])],
+                }])
+    product, = template.products
+    return product
+
+
+def create_parties(args, rng):
+    pool = Pool()
+    Party = pool.get('party.party')
+
+    return Party.create([{
+                'name': 'Customer %s' % i,
+                'remaining_stock': (
+                    'manual' if rng.random() < args.manual
+                    else 'create_shipment'),
+                'addresses': [('create', [{}])],
+                } for i in range(args.parties)])
+
+
+def create_sales(args, rng, parties, product, on_change_party):
+    pool = Pool()
+    Sale = pool.get('sale.sale')
+
+    sales = []
+    for i in range(args.sales):
+        sale = Sale()
+        sale.party = rng.choice(parties)
+        with on_change_party.measure():
+            sale.on_change_party()
+        sale.invoice_method = 'manual'
+        sale.lines = [{
+                'product': product.id,
+                'unit': product.default_uom.id,
+                'quantity': rng.randint(2, 10),
+                'unit_price': Decimal(10),
+                } for _ in range(rng.randint(args.min_lines, args.max_lines))]
+        sales.append(sale)
+    Sale.save(sales)
+    Sale.quote(sales)
+    Sale.confirm(sales)
+    return sales
+
+
+def close_shipments(args, rng, sales):
+    "Ship partially or cancel some of the shipments of the sales"
+    pool = Pool()
+    Move = pool.get('stock.move')
+    ShipmentOut = pool.get('stock.shipment.out')
+
+    to_do, to_cancel = [], []
+    for sale in sales:
+        for shipment in sale.shipments:
+            if shipment.state not in {'waiting', 'draft'}:
+                continue
+            value = rng.random()
+            if value < args.cancel:
+                to_cancel.append(shipment)
+            elif value < args.cancel + args.partial:
+                to_do.append(shipment)
+    if to_cancel:
+        ShipmentOut.cancel(to_cancel)
+    if to_do:
+        ShipmentOut.draft(to_do)
+        moves = []
+        for shipment in to_do:
+            for move in shipment.outgoing_moves:
+                if rng.random() < 0.5:
+                    move.quantity = max(move.quantity // 2, 1)
+                    moves.append(move)
+        Move.save(moves)
+        ShipmentOut.wait(to_do)
+        ShipmentOut.assign_force(to_do)
+        ShipmentOut.pick(to_do)
+        ShipmentOut.pack(to_do)
+        ShipmentOut.do(to_do)
+
+
+def batches(records, size):
+    for i in range(0, len(records), size):
+        yield records[i:i + size]
+
+
+def run(args, counter):
+    pool = Pool()
+    Sale = pool.get('sale.sale')
+
+    rng = random.Random(args.seed)
+    stats = {name: Stats(name, counter) for name in [
+            'on_change_party', 'create_shipment', 'process (initial)',
+            '_process_fulfillment', 'process (steady)']}
+
+    company = create_company()
+    with set_company(company):
+        product = create_product()
+        parties = create_parties(args, rng)
+        sales = create_sales(
+            args, rng, parties, product, stats['on_change_party'])
+
+        for sale in Sale.browse(sales):
+            with stats['create_shipment'].measure():
+                sale.create_shipment('out')
+                sale.create_shipment('return')
+
+        for batch in batches(sales, args.batch):
+            with stats['process (initial)'].measure():
+                Sale.process(Sale.browse(batch))
+
+        close_shipments(args, rng, Sale.browse(sales))
+
+        for batch in batches(sales, args.batch):
+            with stats['_process_fulfillment'].measure():
+                Sale._process_fulfillment(Sale.browse(batch))
+
+        for batch in batches(sales, args.batch):
+            with stats['process (steady)'].measure():
+                Sale.process(Sale.browse(batch))
+
+    print(Stats.header())
+    for stat in stats.values():
+        print(stat.report())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the remaining stock processing")
+    parser.add_argument('--sales', type=int, default=100,
+        help="number of sales (default: %(default)s)")
+    parser.add_argument('--parties', type=int, default=20,
+        help="number of customers (default: %(default)s)")
+    parser.add_argument('--min-lines', type=int, default=1,
+        help="minimal number of lines per sale (default: %(default)s)")
+    parser.add_argument('--max-lines', type=int, default=20,
+        help="maximal number of lines per sale (default: %(default)s)")
+    parser.add_argument('--manual', type=float, default=0.5,
+        help="ratio of manual remaining stock customers "
+        "(default: %(default)s)")
+    parser.add_argument('--partial', type=float, default=0.4,
+        help="ratio of partially done shipments (default: %(default)s)")
+    parser.add_argument('--cancel', type=float, default=0.1,
+        help="ratio of cancelled shipments (default: %(default)s)")
+    parser.add_argument('--batch', type=int, default=20,
+        help="number of sales processed per call (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0,
+        help="seed of the random generator (default: %(default)s)")
+    args = parser.parse_args()
+
+    # The SQLite backend traces the statements only if the logger is enabled
+    # when the connection is opened
+    counter = QueryCounter()
+    counter.install()
+    activate_module('sale_remaining_stock')
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        try:
+            run(args, counter)
+        finally:
+            transaction.rollback()
+
+
+if __name__ == '__main__':
+    main()
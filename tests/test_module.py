@@ -1,14 +1,884 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import io
+import math
+import unittest
+from collections import defaultdict
+from decimal import Decimal
+from unittest.mock import Mock, patch
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond import backend, config
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.model.exceptions import SQLConstraintError
+from trytond.modules.sale_remaining_stock.common import delete_duplicates
+from trytond.modules.sale_remaining_stock.stats import (
+    get_stats, profile, reset_stats)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
 
 
 class SaleRemainingStockTestCase(CompanyTestMixin, ModuleTestCase):
     'Test SaleRemainingStock module'
     module = 'sale_remaining_stock'
 
+    def _create_product(self):
+        pool = Pool()
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, = Template.create([{
+                    'name': 'Product',
+                    'type': 'goods',
+                    'salable': True,
+                    'default_uom': unit.id,
+                    'sale_uom': unit.id,
+                    'list_price': Decimal(10),
+                    'products': [('create', [{}])],
+                    }])
+        product, = template.products
+        return product
+
+    def _create_party(self, remaining_stock):
+        pool = Pool()
+        Party = pool.get('party.party')
+
+        party, = Party.create([{
+                    'name': 'Customer',
+                    'remaining_stock': remaining_stock,
+                    'addresses': [('create', [{}])],
+                    }])
+        return party
+
+    def _create_sale(self, party, product, quantities):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        sale = Sale()
+        sale.party = party
+        sale.on_change_party()
+        sale.invoice_method = 'manual'
+        sale.lines = [{
+                'product': product.id,
+                'unit': product.default_uom.id,
+                'quantity': quantity,
+                'unit_price': Decimal(10),
+                } for quantity in quantities]
+        sale.save()
+        Sale.quote([sale])
+        Sale.confirm([sale])
+        Sale.process([sale])
+        return sale
+
+    def _ship_partially(self, shipment, quantity):
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        Move = pool.get('stock.move')
+
+        ShipmentOut.draft([shipment])
+        move = shipment.outgoing_moves[0]
+        Move.write([move], {'quantity': quantity})
+        ShipmentOut.wait([shipment])
+        ShipmentOut.assign_force([shipment])
+        ShipmentOut.pick([shipment])
+        ShipmentOut.pack([shipment])
+        ShipmentOut.do([shipment])
+
+    @with_transaction()
+    def test_remaining_stock_manual_reference(self):
+        "Test remaining stock manual matches the reference implementation"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        ShipmentOut = pool.get('stock.shipment.out')
+
+        company = create_company()
+        with set_company(company):
+            product = self._create_product()
+            manual = self._create_party('manual')
+            create_shipment = self._create_party('create_shipment')
+
+            sales = [
+                self._create_sale(manual, product, [2, 3]),
+                self._create_sale(manual, product, [2, 3]),
+                self._create_sale(create_shipment, product, [2, 3]),
+                ]
+            for sale in sales[1:]:
+                shipment, = sale.shipments
+                self._ship_partially(shipment, 1)
+                ShipmentOut.save(sale.create_shipment('out'))
+
+            sales = Sale.browse(sales)
+            self.assertEqual(
+                [s.has_closed_shipment for s in sales], [False, True, True])
+            to_cancel, to_ignore = Sale._get_remaining_stock_manual(sales)
+            ref_cancel, ref_ignore = (
+                Sale._get_remaining_stock_manual_reference(sales))
+
+            self.assertEqual(len(to_cancel), 1)
+            self.assertEqual(to_ignore, [sales[1]])
+            self.assertEqual(set(to_cancel), set(ref_cancel))
+            self.assertEqual(to_ignore, ref_ignore)
+
+            summary, = sales[1].remaining_stock_warehouses
+            self.assertEqual(summary.warehouse, to_cancel[0].warehouse)
+            self.assertTrue(summary.closed)
+            self.assertTrue(summary.pending)
+            self.assertEqual(sales[2].remaining_stock_warehouses, ())
+
+            Sale._process_fulfillment([sales[1]])
+            summary, = sales[1].remaining_stock_warehouses
+            self.assertTrue(summary.closed)
+            self.assertFalse(summary.pending)
+
+    @with_transaction()
+    def test_remaining_stock_manual_mixed_policies(self):
+        "Test remaining stock manual with a shipment of mixed policies"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Move = pool.get('stock.move')
+        ShipmentOut = pool.get('stock.shipment.out')
+
+        company = create_company()
+        with set_company(company):
+            product = self._create_product()
+            manual = self._create_party('manual')
+            create_shipment = self._create_party('create_shipment')
+
+            sale = self._create_sale(manual, product, [2, 3])
+            other = self._create_sale(create_shipment, product, [1])
+            shipment, = sale.shipments
+            self._ship_partially(shipment, 1)
+            pending, = sale.create_shipment('out')
+            pending.save()
+            other_shipment, = other.shipments
+            self.assertEqual(pending.remaining_stock, 'manual')
+            self.assertEqual(other_shipment.remaining_stock, 'create_shipment')
+            Move.write(list(other_shipment.outgoing_moves), {
+                    'shipment': str(pending),
+                    })
+
+            sale = Sale(sale.id)
+            pending = ShipmentOut(pending.id)
+            other_shipment = ShipmentOut(other_shipment.id)
+            self.assertEqual(pending.remaining_stock, 'mixed')
+            self.assertEqual(other_shipment.remaining_stock, None)
+            to_cancel, to_ignore = Sale._get_remaining_stock_manual([sale])
+            self.assertEqual((to_cancel, to_ignore), ([], []))
+            self.assertEqual(
+                (to_cancel, to_ignore),
+                Sale._get_remaining_stock_manual_reference([sale]))
+
+    @with_transaction()
+    def test_has_dropped_remaining_stock(self):
+        "Test has dropped remaining stock"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            product = self._create_product()
+            manual = self._create_party('manual')
+            dropped = self._create_sale(manual, product, [2, 3])
+            other = self._create_sale(manual, product, [1])
+            shipment, = dropped.shipments
+            self._ship_partially(shipment, 1)
+            Sale.process([dropped, other])
+
+            self.assertEqual(
+                [s.has_dropped_remaining_stock
+                    for s in Sale.browse([dropped, other])],
+                [True, False])
+            self.assertEqual(
+                Sale.search([('has_dropped_remaining_stock', '=', True)]),
+                [dropped])
+            self.assertEqual(
+                Sale.search([('has_dropped_remaining_stock', '!=', True)]),
+                [other])
+
+    @with_transaction()
+    def test_remaining_stock_fingerprint(self):
+        "Test unchanged sales are skipped by the fingerprint"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            product = self._create_product()
+            manual = self._create_party('manual')
+            sale = self._create_sale(manual, product, [2, 3])
+            self.assertEqual(Sale._get_remaining_stock_changed([sale]), [])
+
+            shipment, = sale.shipments
+            self._ship_partially(shipment, 1)
+            self.assertEqual(
+                Sale._get_remaining_stock_changed([sale]), [sale])
+
+            Sale.process([sale])
+            _, cancelled = sale.shipments
+            self.assertEqual(cancelled.state, 'cancelled')
+            self.assertEqual(Sale._get_remaining_stock_changed([sale]), [])
+
+            copy, = Sale.copy([sale])
+            self.assertEqual(copy.remaining_stock_fingerprint, None)
+
+    @with_transaction()
+    def test_reconcile_remaining_stock(self):
+        "Test reconcile remaining stock by partitions"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            product = self._create_product()
+            manual = self._create_party('manual')
+            sale = self._create_sale(manual, product, [2, 3])
+            shipment, = sale.shipments
+            self._ship_partially(shipment, 1)
+            pending, = sale.create_shipment('out')
+            pending.save()
+
+            partitions = Sale.reconcile_remaining_stock(dry_run=True)
+            self.assertEqual(partitions, {
+                    (company.id, shipment.warehouse.id): [sale.id],
+                    })
+            self.assertEqual(pending.state, 'draft')
+
+            self.assertEqual(
+                Sale.reconcile_remaining_stock_partition([sale], dry_run=True),
+                (1, 1))
+            self.assertEqual(pending.state, 'draft')
+
+            self.assertEqual(
+                Sale.reconcile_remaining_stock_partition([sale]), (1, 1))
+            self.assertEqual(pending.state, 'cancelled')
+            self.assertEqual(Sale.reconcile_remaining_stock(), {})
+
+    @with_transaction()
+    def test_reconcile_remaining_stock_chunks(self):
+        "Test reconcile remaining stock by chunks of sales"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        ShipmentOut = pool.get('stock.shipment.out')
+        Queue = pool.get('ir.queue')
+
+        if not config.has_section('sale_remaining_stock'):
+            config.add_section('sale_remaining_stock')
+        config.set('sale_remaining_stock', 'process_chunk_size', '1')
+        self.addCleanup(
+            config.set, 'sale_remaining_stock', 'process_chunk_size', '1000')
+
+        company = create_company()
+        with set_company(company):
+            product = self._create_product()
+            manual = self._create_party('manual')
+            sales, pendings = [], []
+            for _ in range(2):
+                sale = self._create_sale(manual, product, [2, 3])
+                shipment, = sale.shipments
+                self._ship_partially(shipment, 1)
+                pending, = sale.create_shipment('out')
+                pending.save()
+                sales.append(sale)
+                pendings.append(pending)
+
+            Sale.reconcile_remaining_stock()
+            tasks = [t for t in Queue.search([])
+                if t.data['method'] == 'reconcile_remaining_stock_partition']
+            self.assertEqual(len(tasks), 2)
+
+            with patch.object(
+                    ShipmentOut, 'lock', wraps=ShipmentOut.lock) as lock:
+                self.assertEqual(
+                    Sale._reconcile_remaining_stock(sales), (2, 2))
+
+            lock.assert_called_once()
+            self.assertEqual(
+                [p.state for p in pendings], ['cancelled', 'cancelled'])
+            for sale in sales:
+                line1, _ = sale.lines
+                self.assertEqual(len(line1.moves_ignored), 1)
+
+    @with_transaction()
+    def test_reconcile_remaining_stock_on_event(self):
+        "Test reconcile remaining stock on shipment events"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        ShipmentOut = pool.get('stock.shipment.out')
+
+        if not config.has_section('sale_remaining_stock'):
+            config.add_section('sale_remaining_stock')
+        config.set('sale_remaining_stock', 'reconcile_on_event', 'True')
+        self.addCleanup(
+            config.set, 'sale_remaining_stock', 'reconcile_on_event', 'False')
+
+        company = create_company()
+        with set_company(company):
+            product = self._create_product()
+            manual = self._create_party('manual')
+            sale = self._create_sale(manual, product, [2, 3])
+            shipment, = sale.shipments
+            self._ship_partially(shipment, 1)
+
+            Sale.process([sale])
+            done, pending = sale.shipments
+            self.assertEqual(done.state, 'done')
+            self.assertEqual(pending.state, 'waiting')
+            self.assertEqual(sale.shipment_state, 'partially shipped')
+            line1, line2 = sale.lines
+            self.assertEqual(line1.moves_ignored, ())
+
+            ShipmentOut.reconcile_remaining_stock([done])
+            self.assertEqual(pending.state, 'cancelled')
+            m1, = line1.moves_ignored
+            self.assertEqual(m1.shipment, pending)
+            self.assertEqual(line2.moves_ignored, ())
+
+            Sale.process([sale])
+            self.assertEqual(sale.shipment_state, 'sent')
+
+    @with_transaction()
+    def test_defer_moves_ignored(self):
+        "Test defer the ignored moves to a queued task"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Queue = pool.get('ir.queue')
+
+        if not config.has_section('sale_remaining_stock'):
+            config.add_section('sale_remaining_stock')
+        config.set('sale_remaining_stock', 'defer_moves_ignored', 'True')
+        self.addCleanup(
+            config.set, 'sale_remaining_stock', 'defer_moves_ignored', 'False')
+
+        company = create_company()
+        with set_company(company):
+            product = self._create_product()
+            manual = self._create_party('manual')
+            sale = self._create_sale(manual, product, [2, 3])
+            shipment, = sale.shipments
+            self._ship_partially(shipment, 1)
+
+            Sale.process([sale])
+            _, pending = sale.shipments
+            self.assertNotEqual(pending.state, 'cancelled')
+            self.assertEqual(sale.shipment_state, 'partially shipped')
+            line1, line2 = sale.lines
+            self.assertEqual(line1.moves_ignored, ())
+
+            task, = [t for t in Queue.search([])
+                if t.data['method'] == 'apply_remaining_stock_moves_ignored']
+            self.assertEqual(list(task.data['args']), [[pending.id], None])
+            task.run()
+            self.assertEqual(pending.state, 'cancelled')
+            m1, = line1.moves_ignored
+            self.assertEqual(m1.shipment, pending)
+            self.assertEqual(line2.moves_ignored, ())
+
+            Sale.process([sale])
+            self.assertEqual(sale.shipment_state, 'sent')
+
+    @with_transaction()
+    def test_remaining_stock_backlog(self):
+        "Test remaining stock backlog"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Backlog = pool.get('sale.remaining_stock.backlog')
+
+        company = create_company()
+        with set_company(company):
+            product = self._create_product()
+            manual = self._create_party('manual')
+            sale = self._create_sale(manual, product, [2, 3])
+            shipment, = sale.shipments
+            self._ship_partially(shipment, 1)
+            Sale.process([sale])
+
+            backlog, = Backlog.search([])
+            self.assertEqual(backlog.company, company)
+            self.assertEqual(backlog.warehouse, shipment.warehouse)
+            self.assertEqual(backlog.product, product)
+            self.assertEqual(backlog.quantity, 1)
+            self.assertEqual(backlog.moves, 1)
+            self.assertEqual(backlog.sales, 1)
+
+            transaction = Transaction()
+            connection = Mock(wraps=transaction.connection)
+            cursor = connection.cursor.return_value = Mock(
+                wraps=transaction.connection.cursor())
+            file = io.StringIO()
+            with patch.object(transaction, 'connection', connection):
+                Backlog.write_csv(
+                    file, [('product', '=', product.id)], size=1)
+            header, row = file.getvalue().splitlines()
+            self.assertEqual(header, (
+                    'warehouse_code,warehouse,product_code,product,'
+                    'quantity,moves,sales'))
+            self.assertEqual(
+                row.split(',')[-3:], ['1.0', '1', '1'])
+            query, _ = cursor.execute.call_args.args
+            self.assertEqual(query.count('GROUP BY'), 1)
+
+    @unittest.skipIf(
+        backend.name != 'postgresql', "requires a server-side cursor")
+    @with_transaction()
+    def test_remaining_stock_backlog_named_cursor(self):
+        "Test remaining stock backlog CSV with a server-side cursor"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Backlog = pool.get('sale.remaining_stock.backlog')
+
+        company = create_company()
+        with set_company(company):
+            product = self._create_product()
+            manual = self._create_party('manual')
+            sale = self._create_sale(manual, product, [2, 3, 4])
+            shipment, = sale.shipments
+            self._ship_partially(shipment, 1)
+            Sale.process([sale])
+
+            transaction = Transaction()
+            connection = Mock(wraps=transaction.connection)
+            file = io.StringIO()
+            with patch.object(transaction, 'connection', connection):
+                Backlog.write_csv(file, size=1)
+            connection.cursor.assert_called_once_with(
+                'sale_remaining_stock_backlog')
+            header, row = file.getvalue().splitlines()
+            self.assertEqual(
+                row.split(',')[-3:], ['2.0', '1', '1'])
+
+    @with_transaction()
+    def test_remaining_stock_policy_cache(self):
+        "Test remaining stock policy is invalidated on modification"
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        Party = pool.get('party.party')
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            party = self._create_party('create_shipment')
+            self.assertEqual(Sale.default_remaining_stock(), 'create_shipment')
+            self.assertEqual(
+                Configuration.get_remaining_stock(party), 'create_shipment')
+
+            Configuration.write([Configuration(1)], {
+                    'remaining_stock': 'manual',
+                    })
+            self.assertEqual(Sale.default_remaining_stock(), 'manual')
+
+            Party.write([party], {'remaining_stock': 'manual'})
+            sale = Sale(party=party)
+            sale.on_change_party()
+            self.assertEqual(sale.remaining_stock, 'manual')
+
+            Configuration.write([Configuration(1)], {
+                    'remaining_stock': 'create_shipment',
+                    })
+            self.assertEqual(
+                Configuration.get_remaining_stock(), 'create_shipment')
+            unsaved = Party(name="Unsaved", remaining_stock='manual')
+            self.assertEqual(
+                Configuration.get_remaining_stock(unsaved), 'manual')
+            self.assertEqual(
+                Configuration.get_remaining_stock(), 'create_shipment')
+
+
+    @with_transaction()
+    def test_remaining_stock_policy_cache_transactions(self):
+        "Test remaining stock policy is invalidated across transactions"
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        Party = pool.get('party.party')
+        cache = Configuration._remaining_stock_cache
+
+        company = create_company()
+        with set_company(company):
+            party = self._create_party('manual')
+        key = (company.id, party.id)
+
+        with Transaction().new_transaction(), set_company(company):
+            self.assertEqual(Configuration.get_remaining_stock(party), 'manual')
+            self.assertEqual(cache.get(key), 'manual')
+
+            with Transaction().new_transaction():
+                self.assertEqual(cache.get(key), 'manual')
+                Party.write([party], {'remaining_stock': 'create_shipment'})
+                # The reset is propagated to the other transactions on commit
+                self.assertIsNone(cache.get(key))
+                self.assertEqual(
+                    Configuration.get_remaining_stock(party),
+                    'create_shipment')
+
+    @with_transaction()
+    def test_create_remaining_stock(self):
+        "Test remaining stock of sales created without on_change_party"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            manual = self._create_party('manual')
+            create_shipment = self._create_party('create_shipment')
+
+            sales = Sale.create([
+                    {'party': manual.id},
+                    {'party': create_shipment.id},
+                    {'party': manual.id, 'remaining_stock': 'create_shipment'},
+                    ])
+
+            self.assertEqual([s.remaining_stock for s in sales], [
+                    'manual', 'create_shipment', 'create_shipment'])
+
+    @with_transaction()
+    def test_resolve_remaining_stock(self):
+        "Test resolve remaining stock of many parties"
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        Party = pool.get('party.party')
+        RemainingStock = pool.get('party.remaining.stock')
+
+        company = create_company()
+        with set_company(company):
+            manual = self._create_party('manual')
+            create_shipment = self._create_party('create_shipment')
+            default, = Party.create([{'name': 'Default'}])
+            Configuration.write([Configuration(1)], {
+                    'remaining_stock': 'manual',
+                    })
+
+            result = Party.resolve_remaining_stock(
+                [manual, create_shipment, default])
+
+            self.assertEqual(result, {
+                    manual.id: 'manual',
+                    create_shipment.id: 'create_shipment',
+                    default.id: 'create_shipment',
+                    })
+            for party in [manual, create_shipment, default]:
+                self.assertEqual(
+                    result[party.id],
+                    Configuration.get_remaining_stock(party))
+
+            RemainingStock.create([{
+                        'party': manual.id,
+                        'company': None,
+                        'remaining_stock': 'create_shipment',
+                        }])
+            self.assertEqual(
+                Party.resolve_remaining_stock([manual]),
+                {manual.id: 'manual'})
+            self.assertEqual(
+                Party.resolve_remaining_stock([manual], company=-1),
+                {manual.id: 'create_shipment'})
+
+    @with_transaction()
+    def test_effective_remaining_stock(self):
+        "Test search and order on effective remaining stock"
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        Party = pool.get('party.party')
+        RemainingStock = pool.get('party.remaining.stock')
+
+        company = create_company()
+        with set_company(company):
+            manual = self._create_party('manual')
+            create_shipment = self._create_party('create_shipment')
+            default, = Party.create([{'name': 'Default'}])
+            fallback, = Party.create([{'name': 'Fallback'}])
+            RemainingStock.delete(
+                RemainingStock.search([('party', '=', fallback.id)]))
+            RemainingStock.create([{
+                        'party': fallback.id,
+                        'company': None,
+                        'remaining_stock': 'manual',
+                        }])
+            Configuration.write([Configuration(1)], {
+                    'remaining_stock': 'manual',
+                    })
+            parties = [manual, create_shipment, default, fallback]
+
+            self.assertEqual(
+                [p.effective_remaining_stock for p in Party.browse(parties)],
+                ['manual', 'create_shipment', 'create_shipment', 'manual'])
+            self.assertEqual(
+                Party.search([
+                        ('id', 'in', [p.id for p in parties]),
+                        ('effective_remaining_stock', '=', 'manual'),
+                        ], order=[('id', 'ASC')]),
+                [manual, fallback])
+            self.assertEqual(
+                Party.search([
+                        ('id', 'in', [p.id for p in parties]),
+                        ], order=[
+                        ('effective_remaining_stock', 'DESC'),
+                        ('id', 'ASC'),
+                        ]),
+                [manual, fallback, create_shipment, default])
+
+    def test_remaining_stock_unique(self):
+        "Test remaining stock unique per party and company"
+        # The integrity error rolls back the transaction
+        for with_company in [True, False]:
+            with self.subTest(with_company=with_company):
+                self._test_remaining_stock_unique(with_company)
+
+    @with_transaction()
+    def _test_remaining_stock_unique(self, with_company):
+        pool = Pool()
+        RemainingStock = pool.get('party.remaining.stock')
+
+        company = create_company()
+        with set_company(company):
+            party = self._create_party('manual')
+            RemainingStock.create([{
+                        'party': party.id,
+                        'company': None,
+                        'remaining_stock': 'manual',
+                        }])
+
+            with self.assertRaises(SQLConstraintError):
+                RemainingStock.create([{
+                            'party': party.id,
+                            'company': company.id if with_company else None,
+                            'remaining_stock': 'create_shipment',
+                            }])
+
+    def test_configuration_remaining_stock_unique(self):
+        "Test configuration remaining stock unique per company"
+        # The integrity error rolls back the transaction
+        for with_company in [True, False]:
+            with self.subTest(with_company=with_company):
+                self._test_configuration_remaining_stock_unique(with_company)
+
+    @with_transaction()
+    def _test_configuration_remaining_stock_unique(self, with_company):
+        pool = Pool()
+        RemainingStock = pool.get('sale.configuration.remaining.stock')
+
+        company = create_company()
+        company_id = company.id if with_company else None
+        RemainingStock.delete(RemainingStock.search([
+                    ('company', '=', company_id),
+                    ]))
+        RemainingStock.create([{
+                    'company': company_id,
+                    'remaining_stock': 'manual',
+                    }])
+
+        with self.assertRaises(SQLConstraintError):
+            RemainingStock.create([{
+                        'company': company_id,
+                        'remaining_stock': 'create_shipment',
+                        }])
+
+    @with_transaction()
+    def test_delete_duplicates(self):
+        "Test delete duplicates keeping the first one"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        LineIgnored = pool.get('sale.line-ignored-stock.move')
+        cursor = Transaction().connection.cursor()
+        table = LineIgnored.__table__()
+
+        company = create_company()
+        with set_company(company):
+            product = self._create_product()
+            manual = self._create_party('manual')
+            sale = self._create_sale(manual, product, [2, 3])
+            shipment, = sale.shipments
+            self._ship_partially(shipment, 1)
+            Sale.process([sale])
+
+            ignored, = LineIgnored.search([])
+            cursor.execute(*table.insert(
+                    [table.sale_line, table.move],
+                    [[ignored.sale_line.id, ignored.move.id]]))
+
+            self.assertTrue(delete_duplicates(
+                    LineIgnored, 'sale_line', 'move'))
+            self.assertEqual(LineIgnored.search([]), [ignored])
+            self.assertFalse(delete_duplicates(
+                    LineIgnored, 'sale_line', 'move'))
+
+    @with_transaction()
+    def test_update_sales_remaining_stock(self):
+        "Test update remaining stock of the sales of parties"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            product = self._create_product()
+            party = self._create_party('create_shipment')
+            confirmed = self._create_sale(party, product, [1])
+            draft = Sale(party=party)
+            draft.on_change_party()
+            draft.save()
+            quotation = Sale(party=party)
+            quotation.on_change_party()
+            quotation.save()
+            Sale.quote([quotation])
+
+            Party.write([party], {'remaining_stock': 'manual'})
+            self.assertEqual(
+                Party.update_sales_remaining_stock([party]), {'manual': 2})
+
+            self.assertEqual(
+                [s.remaining_stock for s in Sale.browse(
+                        [draft, quotation, confirmed])],
+                ['manual', 'manual', 'create_shipment'])
+            self.assertEqual(
+                Party.update_sales_remaining_stock([party]), {'manual': 0})
+
+    @with_transaction()
+    def test_remaining_stock_stats(self):
+        "Test remaining stock statistics"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            product = self._create_product()
+            party = self._create_party('manual')
+
+            reset_stats()
+            Sale.default_remaining_stock()
+            self.assertEqual(get_stats(), {})
+
+            with Transaction().set_context(remaining_stock_stats=True):
+                Sale.default_remaining_stock()
+                self._create_sale(party, product, [1])
+            stats = get_stats()
+
+            self.assertEqual(set(stats), {
+                    'sale.sale.default_remaining_stock',
+                    'sale.sale.on_change_party',
+                    'sale.sale.create_shipment',
+                    'sale.sale._process_fulfillment',
+                    })
+            self.assertEqual(
+                stats['sale.sale._process_fulfillment']['calls'], 1)
+            self.assertEqual(
+                stats['sale.sale.create_shipment']['calls'], 2)
+            self.assertGreater(
+                stats['sale.sale._process_fulfillment']['queries'], 0)
+            self.assertGreater(
+                stats['sale.sale._process_fulfillment']['rows'], 0)
+            reset_stats()
+
+    @with_transaction()
+    def test_remaining_stock_profile(self):
+        "Test remaining stock profile per sale"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            product = self._create_product()
+            party = self._create_party('manual')
+            sale = self._create_sale(party, product, [2, 3])
+            other = self._create_sale(party, product, [1])
+            shipment, = sale.shipments
+            self._ship_partially(shipment, 1)
+
+            with Transaction().set_context(remaining_stock_profile=1), \
+                    self.assertLogs(
+                        'trytond.modules.sale_remaining_stock.stats',
+                        'INFO') as logs:
+                Sale.process([sale, other])
+
+            record, = logs.records
+            self.assertEqual(record.remaining_stock_profile['sale'], sale.id)
+            phases = record.remaining_stock_profile['phases']
+            self.assertTrue({
+                    'skip_grouping', 'fingerprint', 'closed_warehouses',
+                    'policy_check', 'cancellation', 'moves_ignored'}
+                <= set(phases))
+            for name in phases:
+                with self.subTest(phase=name):
+                    self.assertGreater(phases[name]['queries'], 0)
+
+    def _create_sale_shipments(self, party, product, lines, shipments):
+        "Create a sale of lines with its moves split in shipments"
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        Move = pool.get('stock.move')
+
+        sale = self._create_sale(party, product, [2] * lines)
+        shipment, = sale.shipments
+        moves = list(shipment.outgoing_moves)
+        for i in range(1, shipments):
+            other, = ShipmentOut.copy([shipment], default={'moves': None})
+            Move.write(moves[i::shipments], {'shipment': str(other)})
+        self._ship_partially(shipment, 1)
+        return sale
+
+    def _assert_scaling(self, counts):
+        "Assert the counts per size grow at most logarithmically"
+        base = counts[min(counts)]
+        for size, count in counts.items():
+            self.assertLessEqual(
+                count, base + math.ceil(math.log2(size)),
+                msg="%s queries for size %s" % (count, size))
+
+    @with_transaction()
+    def test_process_fulfillment_query_count(self):
+        "Test queries of process fulfillment do not grow with the sale size"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            product = self._create_product()
+            party = self._create_party('manual')
+
+            counts = defaultdict(dict)
+            for lines, shipments in [(1, 1), (10, 5), (100, 20), (1000, 50)]:
+                sale = self._create_sale_shipments(
+                    party, product, lines, shipments)
+                with profile() as current:
+                    Sale.process([sale])
+                phases = current.sales[sale.id]
+                for name in [
+                        'skip_grouping', 'fingerprint', 'closed_warehouses',
+                        'policy_check', 'moves_ignored']:
+                    counts[name][lines] = phases[name]['queries']
+                self.assertEqual(
+                    [s.state for s in sale.shipments].count('cancelled'),
+                    shipments)
+
+            for name, name_counts in counts.items():
+                with self.subTest(phase=name):
+                    self._assert_scaling(name_counts)
+
+    @with_transaction()
+    def test_on_change_party_query_count(self):
+        "Test queries of on_change_party do not grow with the parties"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            counts = {}
+            for size in [1, 10, 100, 1000]:
+                parties = Party.create([{
+                            'name': 'Customer %s' % i,
+                            'remaining_stock': 'manual',
+                            } for i in range(size)])
+                reset_stats()
+                with Transaction().set_context(remaining_stock_stats=True):
+                    for party in parties:
+                        sale = Sale(party=party)
+                        sale.on_change_party()
+                stats = get_stats()['sale.sale.on_change_party']
+                counts[size] = math.ceil(stats['queries'] / size)
+            reset_stats()
+
+            self._assert_scaling(counts)
+
 
 del ModuleTestCase